@@ -1,10 +1,43 @@
+import math
 import threading
 import time
+import uuid
+from types import MappingProxyType
 import cv2
 import mss
-from typing import Optional, Tuple, Dict, List, Union
-
-from utils import draw_rotated_rect
+from typing import Optional, Tuple, Dict, List, Any, Callable, NamedTuple, Mapping
+
+from utils import draw_rotated_rect, obb_visible, LabelSpriteCache
+from latency import LatencyWindow, TimedLock
+
+# Umbrales de nivel de detalle (LOD) por defecto para el overlay
+DEFAULT_LOD = {
+    "cull_offscreen": True,   # no dibujar OBBs completamente fuera del frame
+    "min_box_px": 1.0,        # lado mayor < esto -> no se dibuja la caja
+    "min_label_px": 12.0,     # lado menor < esto -> sin etiqueta ni punto central
+    "max_labels": 300,        # más cajas visibles que esto -> sin etiquetas ni puntos
+}
+
+# Intervalo mínimo entre snapshots publicados para escrituras sueltas (~1 por frame a 60 fps)
+OBB_PUBLISH_INTERVAL_S = 1.0 / 60
+
+class Frame(NamedTuple):
+    """Frame publicado: JPEG + trazabilidad (timestamps en time.monotonic())."""
+    jpeg: bytes
+    seq: int
+    ts_capture: float
+    ts_encoded: float
+
+# id -> (cx, cy, w, h, angle_deg_cv, (b,g,r))
+Obb = Tuple[float, float, float, float, float, Tuple[int, int, int]]
+
+class ObbSnapshot(NamedTuple):
+    """
+    Conjunto inmutable de OBBs. Los escritores publican uno nuevo (copy-on-write)
+    y el bucle de captura lo lee sin lock: nunca se modifica tras publicarse.
+    """
+    version: int
+    obbs: Mapping[int, Obb]
 
 def _video_backends():
     # En Windows suele ir mejor DSHOW y MSMF. En Linux/macOS usa el default.
@@ -33,7 +66,8 @@ def _try_set_res(cap, w, h, fourcc: Optional[str]) -> bool:
     hh, ww = frame.shape[:2]
     return (ww == w and hh == h)
 
-def _negotiate_resolution(cap) -> Tuple[int, int]:
+def _negotiate_resolution(cap, aborted: Callable[[], bool] = lambda: False) -> Optional[Tuple[int, int]]:
+    # Devuelve None si `aborted()` se vuelve True entre candidatos (p.ej. stop() durante el arranque)
     # Lista de resoluciones UVC comunes (mayor→menor). Añade más si tu cámara las soporta.
     candidates = [
         (3840,2160), (2560,1440), (2592,1944),  # 4K / QHD / 5MP 4:3
@@ -48,6 +82,8 @@ def _negotiate_resolution(cap) -> Tuple[int, int]:
     # 1) prueba cada fourcc con resoluciones de mayor a menor
     for fcc in fourccs:
         for (w, h) in candidates:
+            if aborted():
+                return None
             if _try_set_res(cap, w, h, fcc):
                 return w, h
 
@@ -62,27 +98,113 @@ class CameraWorker:
     def __init__(self):
         self._thread: Optional[threading.Thread] = None
         self._running = False
-        self._lock = threading.Lock()
-
-        # id -> (cx, cy, w, h, angle_deg_cv, (b,g,r))
-        self._obbs: Dict[int, Tuple[float, float, float, float, float, Tuple[int, int, int]]] = {}
+        # Locks separados (todos miden su tiempo de espera, ver get_lock_stats):
+        #   _lock:       estado de ejecución / job de arranque / meta
+        #   _obb_lock:   serializa escritores de OBBs (el bucle de captura no lo toma)
+        #   _frame_lock: último frame publicado
+        self._lock = TimedLock()
+        self._obb_lock = TimedLock()
+        self._frame_lock = TimedLock()
+
+        self._obb_snap = ObbSnapshot(0, MappingProxyType({}))
+        # escrituras sueltas pendientes de publicar (id -> OBB, o None = borrado);
+        # el hilo publicador las aplica en UN solo snapshot (ver _commit_pending).
+        # _inflight: lote ya retirado de _pending que se está copiando (aún no visible)
+        self._pending: Dict[int, Optional[Obb]] = {}
+        self._inflight: Dict[int, Optional[Obb]] = {}
+        self._obb_cond = threading.Condition(self._obb_lock)
+        self._commit_lock = threading.Lock()  # un solo commit a la vez (publicador o lectura de la API)
+        self._publisher: Optional[threading.Thread] = None
+        self._single_writes = 0
+        self._commits = 0
 
         self._cam_index = 0
-        self._last_jpeg: Optional[bytes] = None
+        self._last_frame: Optional[Frame] = None
+        self._seq = 0  # no se reinicia entre arranques (los clientes esperan seq creciente)
+        self._frame_cond = threading.Condition(self._frame_lock)
+        self._capture_latency = LatencyWindow()  # captura -> JPEG codificado
+
+        # job de arranque actual (ver start()); _state_cond permite long-polling
+        self._job: Optional[dict] = None
+        self._state_cond = threading.Condition(self._lock)
 
         # meta (opcional)
         self._frame_w: Optional[int] = None
         self._frame_h: Optional[int] = None
 
-    def start(self, cam_index: int = 0) -> Union[tuple[bool, Optional[int], Optional[int]], None, tuple[bool, None, None], tuple[bool, int, int]]:
+        # consumidores de frames codificados: callback(jpeg, ts_monotonic); no deben bloquear.
+        # Tupla reemplazada entera al cambiar, para leerla sin lock en el bucle.
+        self._consumers: Tuple[Callable[[bytes, float], None], ...] = ()
+
+        # LOD del overlay (dict reemplazado entero, nunca mutado) + cache de etiquetas
+        # (la cache solo la usa el hilo de captura)
+        self._lod = dict(DEFAULT_LOD)
+        self._labels = LabelSpriteCache()
+
+    def start(self, cam_index: int = 0, hydrate: Optional[Callable[[], List[tuple]]] = None) -> Tuple[bool, Optional[dict]]:
+        """
+        Arranca la cámara en segundo plano y devuelve de inmediato (started, job).
+        El job avanza por opening -> negotiating -> hydrating -> streaming
+        (o failed/stopped); consúltalo con get_job()/wait_job().
+        hydrate: callable opcional (p.ej. lectura de DB) que devuelve los items para
+        set_bboxes; corre en paralelo a la negociación y solo se aplica si el job
+        sigue vigente al llegar a 'streaming'.
+        started=False si ya está en ejecución o si el hilo del arranque anterior
+        aún no terminó de liberar la cámara (is_running() es False en ese caso).
+        """
         with self._lock:
             if self._running:
-                return False, self._frame_w, self._frame_h
+                return False, self._job_status()
+            if self._thread is not None and self._thread.is_alive():
+                return False, self._job_status()
             self._running = True
             self._cam_index = cam_index
             self._frame_w = None
             self._frame_h = None
+            self._job = {
+                "job_id": uuid.uuid4().hex,
+                "state": "opening",
+                "error": None,
+                "hydrated": None,
+                "started_at": time.time(),
+                "updated_at": time.time(),
+            }
+            job_id = self._job["job_id"]
+            self._state_cond.notify_all()
+
+        self._thread = threading.Thread(target=self._run, args=(job_id, hydrate), daemon=True)
+        self._thread.start()
+        with self._lock:
+            return True, self._job_status()
+
+    # === Máquina de estados del arranque ===
+    def _set_state(self, job_id: str, state: str, **fields) -> bool:
+        """Cambia el estado del job (si sigue siendo el actual). False si se abortó."""
+        with self._lock:
+            if self._job is None or self._job["job_id"] != job_id:
+                return False
+            if self._job["state"] in ("failed", "stopped"):
+                return False
+            self._job.update(fields, state=state, updated_at=time.time())
+            if state in ("failed", "stopped"):
+                self._running = False
+            self._state_cond.notify_all()
+            return self._running
+
+    def _is_current(self, job_id: str) -> bool:
+        # lectura sin lock (referencias atómicas); para chequeos frecuentes en el hilo del job
+        job = self._job
+        return self._running and job is not None and job["job_id"] == job_id
+
+    def _job_status(self) -> Optional[dict]:
+        # requiere self._lock tomado
+        if self._job is None:
+            return None
+        out = dict(self._job)
+        out["w"], out["h"] = self._frame_w, self._frame_h
+        return out
 
+    def _run(self, job_id: str, hydrate: Optional[Callable[[], List[tuple]]]) -> None:
         # Define qué capturar: toda la pantalla principal
         # sct = mss.mss()
         # monitor = sct.monitors[1]  # 1 = monitor principal
@@ -118,99 +240,241 @@ class CameraWorker:
         #     if ok2:
         #         self._last_jpeg = buf.tobytes()
 
+        # --- hidratación en paralelo a apertura/negociación. Solo LEE; el resultado
+        # se aplica al worker más abajo si el job sigue vigente (si no, se descarta).
+        hydrate_result: Dict[str, Any] = {}
+
+        def _hydrate():
+            try:
+                hydrate_result["items"] = hydrate()
+            except Exception as e:
+                hydrate_result["error"] = e
+
+        hydrate_thread = None
+        if hydrate is not None:
+            hydrate_thread = threading.Thread(target=_hydrate, daemon=True)
+            hydrate_thread.start()
+
         # --- abrir con el mejor backend disponible
+        # (abrir en DSHOW/MSMF puede tardar: se comprueba el job entre backends)
         cap = None
         for backend in _video_backends():
+            if not self._is_current(job_id):
+                return
             cap = cv2.VideoCapture(self._cam_index, backend) if backend != 0 else cv2.VideoCapture(self._cam_index)
+            if not self._is_current(job_id):
+                cap.release()
+                return
             if cap.isOpened():
                 break
+            cap.release()
         if cap is None or not cap.isOpened():
-            with self._lock:
-                self._running = False
             print("No se pudo abrir la cámara.")
-            return False, None, None
+            self._set_state(job_id, "failed", error="No se pudo abrir la cámara")
+            return
 
         # --- negociar mejor resolución disponible y confirmar con frame real
-        w, h = _negotiate_resolution(cap)
+        if not self._set_state(job_id, "negotiating"):
+            cap.release()
+            return
+        res = _negotiate_resolution(cap, aborted=lambda: not self._is_current(job_id))
+        if res is None:
+            cap.release()
+            return
         ok, frame = cap.read()
+        ts_capture = time.monotonic()
         if not ok:
             cap.release()
-            with self._lock:
-                self._running = False
             print("No se pudo leer el primer frame.")
-            return False, None, None
+            self._set_state(job_id, "failed", error="No se pudo leer el primer frame")
+            return
 
         hh, ww = frame.shape[:2]
         ok2, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        # publicar solo si este job sigue siendo el actual (orden de locks: _lock -> _frame_lock)
         with self._lock:
+            if not self._is_current(job_id):
+                cap.release()
+                return
             self._frame_w, self._frame_h = int(ww), int(hh)
             if ok2:
-                self._last_jpeg = buf.tobytes()
-
-        def _loop(existing_cap):
+                with self._frame_lock:
+                    self._publish_locked(buf.tobytes(), ts_capture)
 
-            cap_local = existing_cap
+        # --- esperar a que termine la hidratación (normalmente ya terminó)
+        if not self._set_state(job_id, "hydrating"):
+            cap.release()
+            return
+        if hydrate_thread is not None:
+            hydrate_thread.join()
+        if "error" in hydrate_result:
+            cap.release()
+            print(f"Error al hidratar OBBs: {hydrate_result['error']}")
+            self._set_state(job_id, "failed", error=f"Error al hidratar: {hydrate_result['error']}")
+            return
 
-            try:
-                while True:
-                    with self._lock:
-                        running = self._running
-                        obb_items = list(self._obbs.items())  # copia para iterar fuera del lock
-                    if not running:
-                        break
-
-                    ok, frame = cap_local.read()
-                    if not ok:
-                        print("No se pudo leer el frame")
-                        break
-
-                    # === Dibujo ===
-                    for bid, (cx, cy, bw, bh, angle_cv, color_bgr) in obb_items:
-                        draw_rotated_rect(frame, cx, cy, bw, bh, angle_cv, color_bgr, 2)
-                        # marcador e ID
+        items = hydrate_result.get("items", [])
+        with self._lock:
+            if not self._is_current(job_id):
+                cap.release()
+                return
+            # bajo _lock: un stop()/start() no puede colarse entre el chequeo y la aplicación
+            self.set_bboxes(items)
+        if not self._set_state(job_id, "streaming", hydrated=len(items)):
+            cap.release()
+            return
+        self._loop(job_id, cap)
+
+    def _loop(self, job_id: str, cap) -> None:
+        try:
+            while True:
+                # lecturas atómicas de referencias inmutables: sin lock en la ruta caliente
+                if not self._is_current(job_id):
+                    break
+                obbs = self._obb_snap.obbs
+                lod = self._lod
+
+                ok, frame = cap.read()
+                ts_capture = time.monotonic()
+                if not ok:
+                    print("No se pudo leer el frame")
+                    break
+
+                # === Dibujo ===
+                fh, fw = frame.shape[:2]
+                visible = []
+                for it in obbs.items():
+                    cx, cy, bw, bh, angle_cv, _col = it[1]
+                    if max(bw, bh) < lod["min_box_px"]:
+                        continue
+                    if lod["cull_offscreen"] and not obb_visible(fw, fh, cx, cy, bw, bh, angle_cv):
+                        continue
+                    visible.append(it)
+
+                labels = len(visible) <= lod["max_labels"]
+                for bid, (cx, cy, bw, bh, angle_cv, color_bgr) in visible:
+                    draw_rotated_rect(frame, cx, cy, bw, bh, angle_cv, color_bgr, 2)
+                    # marcador e ID (solo si la caja es suficientemente grande)
+                    if labels and min(bw, bh) >= lod["min_label_px"]:
                         cv2.circle(frame, (int(cx), int(cy)), 3, (255, 255, 255), -1)
-                        cv2.putText(frame, str(bid), (int(cx) + 6, int(cy) - 6), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color_bgr, 2, cv2.LINE_AA)
-
-                    # Mostrar UI de OpenCv
-                    # 1 ms para refrescar; si se presiona 'q' se cierra
-                    cv2.imshow("Preview", frame)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        with self._lock:
-                            self._running = False
-                        break
-
-                    ok2, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                    if ok2:
-                        with self._lock:
-                            self._last_jpeg = buf.tobytes()
-                    time.sleep(0.015)  # ~66 FPS máx
-            finally:
-                cap_local.release()
-                try:
-                    cv2.destroyAllWindows()
-                except:
-                    pass
+                        self._labels.blit(frame, bid, int(cx) + 6, int(cy) - 6, color_bgr)
 
-            cap.release()
+                if len(self._labels) > len(obbs):
+                    self._labels.prune(obbs.keys())
 
-        self._thread = threading.Thread(target=_loop, args=(cap,), daemon=True)
-        self._thread.start()
-        return True, self._frame_w, self._frame_h
+                # Mostrar UI de OpenCv
+                # 1 ms para refrescar; si se presiona 'q' se cierra
+                cv2.imshow("Preview", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    with self._lock:
+                        self._running = False
+                    break
+
+                ok2, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+                if ok2:
+                    jpeg = buf.tobytes()
+                    with self._frame_lock:
+                        self._publish_locked(jpeg, ts_capture)
+                    for consumer in self._consumers:
+                        try:
+                            consumer(jpeg, ts_capture)
+                        except Exception as e:
+                            print(f"Error en consumidor de frames: {e}")
+                time.sleep(0.015)  # ~66 FPS máx
+        finally:
+            cap.release()
+            try:
+                cv2.destroyAllWindows()
+            except:
+                pass
+            self._set_state(job_id, "stopped")
 
     def stop(self) -> bool:
         with self._lock:
             if not self._running:
                 return False
             self._running = False
-            # limpia todo
-            self._obbs.clear()
-        if self._thread and self._thread.is_alive():
-            self._thread.join(timeout=3.0)
-        self._thread = None
-        self._last_jpeg = None
+            if self._job is not None and self._job["state"] not in ("failed", "stopped"):
+                self._job.update(state="stopped", updated_at=time.time())
+            self._state_cond.notify_all()
+        # despierta a los clientes de /stream.mjpg bloqueados en wait_frame
+        with self._frame_lock:
+            self._frame_cond.notify_all()
+        thread = self._thread
+        if thread and thread.is_alive():
+            thread.join(timeout=3.0)
+        # Si sigue vivo (p.ej. bloqueado en VideoCapture/negociación) se conserva la
+        # referencia: start() se niega a arrancar hasta que termine de liberar la cámara.
+        if thread is not None and not thread.is_alive() and self._thread is thread:
+            self._thread = None
+        # limpia todo
+        self.clear_bboxes()
+        with self._frame_lock:
+            self._last_frame = None
+            self._frame_cond.notify_all()
         return True
 
+    def _publish_locked(self, jpeg: bytes, ts_capture: float) -> None:
+        # requiere self._frame_lock tomado
+        ts_encoded = time.monotonic()
+        self._seq += 1
+        self._last_frame = Frame(jpeg, self._seq, ts_capture, ts_encoded)
+        self._capture_latency.add(ts_encoded - ts_capture)
+        self._frame_cond.notify_all()
+
     # === Multi-OBB API ===
+    def _replace_obbs(self, obbs: Dict[int, Obb]) -> ObbSnapshot:
+        # requiere self._obb_lock tomado; `obbs` no debe volver a mutarse
+        snap = ObbSnapshot(self._obb_snap.version + 1, MappingProxyType(obbs))
+        self._obb_snap = snap  # asignación atómica: el lector ve el viejo o el nuevo
+        return snap
+
+    def _commit_pending(self) -> ObbSnapshot:
+        """
+        Publica las escrituras sueltas acumuladas en un único snapshot nuevo.
+        Lo llaman el hilo publicador (como mucho cada OBB_PUBLISH_INTERVAL_S) y las
+        lecturas de la API (para ver sus propias escrituras); nunca el bucle de captura.
+        La copia O(n) se hace fuera de _obb_lock: los escritores solo esperan el
+        intercambio de dicts. Si un reemplazo masivo (set/clear) llega durante la
+        copia, el lote se descarta, igual que si hubiera seguido pendiente.
+        """
+        with self._commit_lock:
+            if not self._pending:
+                return self._obb_snap
+            with self._obb_lock:
+                pending, self._pending = self._pending, {}
+                self._inflight = pending
+                base = self._obb_snap
+            obbs = dict(base.obbs)
+            for bid, obb in pending.items():
+                if obb is None:
+                    obbs.pop(bid, None)
+                else:
+                    obbs[bid] = obb
+            with self._obb_lock:
+                self._inflight = {}
+                if self._obb_snap is not base:
+                    return self._obb_snap
+                self._commits += 1
+                return self._replace_obbs(obbs)
+
+    def _publisher_loop(self) -> None:
+        while True:
+            with self._obb_cond:
+                self._obb_cond.wait_for(lambda: self._pending)
+            self._commit_pending()
+            # coalesce: las escrituras de este intervalo van al siguiente snapshot
+            time.sleep(OBB_PUBLISH_INTERVAL_S)
+
+    def _pend_locked(self, bid: int, obb: Optional[Obb]) -> None:
+        # requiere self._obb_lock tomado
+        self._pending[bid] = obb
+        self._single_writes += 1
+        if self._publisher is None:
+            self._publisher = threading.Thread(target=self._publisher_loop, daemon=True)
+            self._publisher.start()
+        self._obb_cond.notify()
+
     def upsert_bbox_rotated(
         self,
         bbox_id: int,
@@ -221,64 +485,218 @@ class CameraWorker:
         angle_deg_cv: float,
         color_bgr: Tuple[int, int, int] = (0, 255, 0),
     ) -> None:
-        """Crea o actualiza un OBB con id."""
-        with self._lock:
-            self._obbs[int(bbox_id)] = (float(cx), float(cy), float(w), float(h), float(angle_deg_cv), tuple(map(int, color_bgr)))
+        """
+        Crea o actualiza un OBB con id. O(1): queda pendiente y el hilo publicador
+        lo publica junto al resto de escrituras del intervalo (ver _commit_pending).
+        """
+        obb = (float(cx), float(cy), float(w), float(h), float(angle_deg_cv), tuple(map(int, color_bgr)))
+        with self._obb_lock:
+            self._pend_locked(int(bbox_id), obb)
 
     def remove_bbox(self, bbox_id: int) -> bool:
-        with self._lock:
-            return self._obbs.pop(int(bbox_id), None) is not None
+        """Elimina un OBB (O(1), pendiente como upsert_bbox_rotated). True si existía."""
+        bid = int(bbox_id)
+        with self._obb_lock:
+            if bid in self._pending:
+                existed = self._pending[bid] is not None
+            elif bid in self._inflight:
+                existed = self._inflight[bid] is not None
+            else:
+                existed = bid in self._obb_snap.obbs
+            if existed:
+                self._pend_locked(bid, None)
+            return existed
 
     def clear_bboxes(self) -> None:
-        with self._lock:
-            self._obbs.clear()
+        with self._obb_lock:
+            self._pending = {}
+            self._inflight = {}
+            self._replace_obbs({})
 
     def set_bboxes(self, items: List[Tuple[int, float, float, float, float, float, Tuple[int, int, int]]]) -> None:
         """
         Reemplaza todas las cajas por las dadas.
         items: lista de tuplas (id, cx, cy, w, h, angle_deg_cv, color_bgr)
         """
-        with self._lock:
-            self._obbs.clear()
-            for it in items:
-                if len(it) == 7:
-                    bid, cx, cy, w, h, ang, col = it
-                else:
-                    # si no trae color, usa verde
-                    bid, cx, cy, w, h, ang = it
-                    col = (0, 255, 0)
-                self._obbs[int(bid)] = (float(cx), float(cy), float(w), float(h), float(ang), tuple(map(int, col)))
+        obbs: Dict[int, Obb] = {}
+        for it in items:
+            if len(it) == 7:
+                bid, cx, cy, w, h, ang, col = it
+            else:
+                # si no trae color, usa verde
+                bid, cx, cy, w, h, ang = it
+                col = (0, 255, 0)
+            obbs[int(bid)] = (float(cx), float(cy), float(w), float(h), float(ang), tuple(map(int, col)))
+        with self._obb_lock:
+            self._pending = {}
+            self._inflight = {}
+            self._replace_obbs(obbs)
+
+    def set_bboxes_array(self, arr) -> int:
+        """
+        Reemplaza todas las cajas a partir de un array estructurado BBOX_DTYPE
+        (ya validado con decode_bboxes_bin). Devuelve cuántas quedaron.
+        """
+        # tolist() convierte columnas completas a tipos Python de una vez
+        ids = arr["id"].tolist()
+        geom = zip(arr["cx"].tolist(), arr["cy"].tolist(), arr["w"].tolist(), arr["h"].tolist(), arr["angle"].tolist())
+        cols = map(tuple, arr["bgr"].tolist())
+        new_obbs = {bid: (cx, cy, w, h, ang, col) for bid, (cx, cy, w, h, ang), col in zip(ids, geom, cols)}
+        with self._obb_lock:
+            self._pending = {}
+            self._inflight = {}
+            self._replace_obbs(new_obbs)
+        return len(new_obbs)
+
+    def get_obb_snapshot(self) -> ObbSnapshot:
+        """Snapshot inmutable y versionado de los OBBs (incluye escrituras pendientes)."""
+        return self._commit_pending()
 
     def get_bboxes(self) -> List[dict]:
         """Devuelve snapshot de OBBs (útil para /meta o debugging)."""
+        out = []
+        for bid, (cx, cy, w, h, ang, col) in self._commit_pending().obbs.items():
+            out.append({
+                "id": int(bid),
+                "cx": float(cx),
+                "cy": float(cy),
+                "w": float(w),
+                "h": float(h),
+                "angle_deg_cv": float(ang),
+                "color_bgr": tuple(col),
+            })
+        return out
+
+    # === Consumidores de frames (p.ej. Recorder) ===
+    def add_frame_consumer(self, consumer: Callable[[bytes, float], None]) -> None:
+        """Registra callback(jpeg, ts) llamado desde el hilo de captura por cada frame anotado."""
         with self._lock:
-            out = []
-            for bid, (cx, cy, w, h, ang, col) in self._obbs.items():
-                out.append({
-                    "id": int(bid),
-                    "cx": float(cx),
-                    "cy": float(cy),
-                    "w": float(w),
-                    "h": float(h),
-                    "angle_deg_cv": float(ang),
-                    "color_bgr": tuple(col),
-                })
-            return out
+            if consumer not in self._consumers:
+                self._consumers = self._consumers + (consumer,)
 
-    def get_last_jpeg(self) -> Optional[bytes]:
+    def remove_frame_consumer(self, consumer: Callable[[bytes, float], None]) -> bool:
+        with self._lock:
+            if consumer in self._consumers:
+                self._consumers = tuple(c for c in self._consumers if c is not consumer)
+                return True
+            return False
+
+    # === LOD del overlay ===
+    def set_lod(self, **params) -> dict:
+        """
+        Actualiza umbrales LOD (claves de DEFAULT_LOD). Lanza ValueError si hay
+        claves desconocidas, booleanos que no son bool, números no finitos o
+        negativos. Devuelve la configuración final.
+        """
+        unknown = set(params) - set(DEFAULT_LOD)
+        if unknown:
+            raise ValueError(f"claves LOD desconocidas: {sorted(unknown)}")
+        parsed = {}
+        for k, v in params.items():
+            default = DEFAULT_LOD[k]
+            if isinstance(default, bool):
+                # bool("false") es True: exige un booleano JSON real
+                if not isinstance(v, bool):
+                    raise ValueError(f"{k} debe ser true/false")
+                parsed[k] = v
+                continue
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                raise ValueError(f"{k} debe ser numérico")
+            if not math.isfinite(v):
+                raise ValueError(f"{k} debe ser finito")
+            val = type(default)(v)
+            if val < 0:
+                raise ValueError(f"{k} debe ser >= 0")
+            parsed[k] = val
         with self._lock:
-            return self._last_jpeg
+            self._lod = {**self._lod, **parsed}
+            return dict(self._lod)
+
+    def get_lod(self) -> dict:
+        return dict(self._lod)
+
+    def get_last_jpeg(self) -> Optional[bytes]:
+        f = self._last_frame
+        return f.jpeg if f else None
+
+    def get_last_frame(self) -> Optional[Frame]:
+        # Frame es inmutable y se reemplaza entero: la lectura de la referencia es atómica
+        return self._last_frame
+
+    def wait_frame(self, after_seq: int, timeout: float = 1.0) -> Optional[Frame]:
+        """
+        Espera hasta `timeout` s un frame con seq > after_seq (sin polling).
+        Devuelve None si no llegó ninguno o la cámara se detuvo.
+        """
+        def _ready():
+            return not self._running or (self._last_frame is not None and self._last_frame.seq > after_seq)
+
+        with self._frame_cond:
+            self._frame_cond.wait_for(_ready, timeout=timeout)
+            f = self._last_frame
+            return f if f is not None and f.seq > after_seq else None
+
+    def get_capture_latency(self) -> dict:
+        """Percentiles captura -> JPEG codificado."""
+        return self._capture_latency.summary()
+
+    def get_lock_stats(self) -> dict:
+        """Tiempo de espera por lock (solo adquisiciones con contención)."""
+        return {
+            "state": self._lock.stats(),
+            "bboxes": self._obb_lock.stats(),
+            "frame": self._frame_lock.stats(),
+            # escrituras sueltas vs snapshots publicados para ellas (coalescencia por frame)
+            "bbox_single_writes": self._single_writes,
+            "bbox_commits": self._commits,
+        }
 
     def is_running(self) -> bool:
+        """True desde que se pide start() hasta stop()/fallo (incluye el arranque)."""
         with self._lock:
             return self._running
 
+    def is_streaming(self) -> bool:
+        """True solo cuando el arranque terminó y el bucle de captura está activo."""
+        with self._lock:
+            return self._running and self._job is not None and self._job["state"] == "streaming"
+
+    def get_job(self, job_id: Optional[str] = None) -> Optional[dict]:
+        """Estado del job de arranque actual (None si no existe o no coincide job_id)."""
+        with self._lock:
+            if self._job is None or (job_id is not None and self._job["job_id"] != job_id):
+                return None
+            return self._job_status()
+
+    def wait_job(self, job_id: str, since: Optional[str] = None, timeout: float = 0.0) -> Optional[dict]:
+        """
+        Long-poll: espera hasta `timeout` s a que el estado del job sea distinto de
+        `since` (o a que sea terminal si since es None). Devuelve el estado actual.
+        """
+        terminal = ("streaming", "failed", "stopped")
+
+        def _changed():
+            if self._job is None or self._job["job_id"] != job_id:
+                return True
+            state = self._job["state"]
+            return state != since if since is not None else state in terminal
+
+        with self._state_cond:
+            if timeout > 0:
+                self._state_cond.wait_for(_changed, timeout=timeout)
+            if self._job is None or self._job["job_id"] != job_id:
+                return None
+            return self._job_status()
+
     def get_meta(self):
+        snap = self._commit_pending()
         with self._lock:
             return {
                 "running": self._running,
+                "state": self._job["state"] if self._job else "idle",
                 "frame_w": self._frame_w,
                 "frame_h": self._frame_h,
-                "multi_count": len(self._obbs),
-                "bbox_ids": list(self._obbs.keys())
+                "multi_count": len(snap.obbs),
+                "bbox_ids": list(snap.obbs.keys()),
+                "bbox_version": snap.version,
             }
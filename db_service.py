@@ -1,6 +1,9 @@
 import os
 import sqlite3
-from typing import Optional, Dict, Any, List, Iterable
+from typing import Optional, Dict, Any, List, Iterable, Iterator, Sequence, Tuple
+
+# Columnas consultables (para proyección de campos)
+BBOX_COLUMNS = ("id", "cx", "cy", "w", "h", "angle_deg_cv", "color_hex", "created_at")
 
 class DatabaseService:
     def __init__(self, db_path: str = "app.db"):
@@ -29,6 +32,12 @@ class DatabaseService:
                     created_at TEXT NOT NULL DEFAULT (CURRENT_TIMESTAMP)  -- UTC
                 );
             """)
+            # Índice para el listado paginado (ORDER BY created_at DESC, id DESC sin sort en memoria).
+            # created_at es 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP): orden lexicográfico == cronológico.
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_bboxes_created_id ON bboxes(created_at DESC, id DESC);")
+            # Filtro por color + mismo orden: compuesto para no ordenar en memoria (TEMP B-TREE)
+            cur.execute("DROP INDEX IF EXISTS idx_bboxes_color;")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_bboxes_color_created_id ON bboxes(color_hex, created_at DESC, id DESC);")
             # Modo WAL: mejor para múltiples hilos/lecturas concurrentes
             cur.execute("PRAGMA journal_mode=WAL;")
             conn.commit()
@@ -61,11 +70,70 @@ class DatabaseService:
 
     def get_all_bboxes(self) -> List[Dict[str, Any]]:
         """Lista todas las filas (más recientes primero por created_at)."""
+        return list(self.iter_bboxes())
+
+    def iter_bboxes(self, *,
+                    limit: Optional[int] = None,
+                    after: Optional[Tuple[str, int]] = None,
+                    fields: Optional[Sequence[str]] = None,
+                    region: Optional[Tuple[float, float, float, float]] = None,
+                    color_hex: Optional[str] = None,
+                    ordered: bool = True,
+                    batch_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """
+        Recorre filas con un cursor (fetchmany), sin cargar toda la tabla en memoria.
+          limit:     máximo de filas
+          after:     cursor keyset (created_at, id) de la última fila ya vista
+          fields:    columnas a devolver (subconjunto de BBOX_COLUMNS); None = todas
+          region:    (x0, y0, x1, y1) -> solo cajas con centro dentro
+          color_hex: '#RRGGBB' exacto
+          ordered:   False evita el ORDER BY (p.ej. hidratación, donde el orden no importa)
+        """
+        cols = list(BBOX_COLUMNS) if not fields else [c for c in BBOX_COLUMNS if c in fields]
+        unknown = set(fields or ()) - set(BBOX_COLUMNS)
+        if unknown:
+            raise ValueError(f"campos desconocidos: {sorted(unknown)}")
+
+        where, params = [], []
+        if after is not None:
+            where.append("(created_at, id) < (?, ?)")
+            params += [str(after[0]), int(after[1])]
+        if region is not None:
+            x0, y0, x1, y1 = map(float, region)
+            where.append("cx BETWEEN ? AND ? AND cy BETWEEN ? AND ?")
+            params += [min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)]
+        if color_hex is not None:
+            where.append("color_hex = ?")
+            params.append(str(color_hex))
+
+        sql = f"SELECT {', '.join(cols)} FROM bboxes"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if ordered:
+            sql += " ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+
+        conn = self._connect()
+        conn.row_factory = None  # tuplas: más baratas que sqlite3.Row
+        try:
+            cur = conn.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield dict(zip(cols, r))
+        finally:
+            conn.close()
+
+    def has_ids_outside(self, lo: int, hi: int) -> bool:
+        """True si existe alguna fila con id fuera de [lo, hi] (búsqueda por PK)."""
         with self._connect() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT * FROM bboxes ORDER BY datetime(created_at) DESC, id DESC")
-            rows = cur.fetchall()
-            return [dict(r) for r in rows]
+            cur.execute("SELECT 1 FROM bboxes WHERE id < ? OR id > ? LIMIT 1", (int(lo), int(hi)))
+            return cur.fetchone() is not None
 
     def update_bbox(self, id: int, **fields: Any) -> bool:
         """
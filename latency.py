@@ -0,0 +1,119 @@
+import math
+import threading
+import time
+from collections import deque, OrderedDict
+from typing import Deque, Dict, Optional
+
+def _percentile(sorted_vals, p: float) -> float:
+    # nearest-rank sobre una lista ya ordenada
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals), math.ceil(p / 100.0 * len(sorted_vals))) - 1)
+    return sorted_vals[k]
+
+class LatencyWindow:
+    """Ventana deslizante de muestras de latencia (segundos) con percentiles."""
+
+    def __init__(self, maxlen: int = 1000):
+        self._lock = threading.Lock()
+        self._samples: Deque[float] = deque(maxlen=maxlen)
+        self._total = 0
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self._total += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            vals = sorted(self._samples)
+            total = self._total
+        return {
+            "count": total,
+            "window": len(vals),
+            "p50_ms": round(_percentile(vals, 50) * 1000.0, 3),
+            "p95_ms": round(_percentile(vals, 95) * 1000.0, 3),
+            "p99_ms": round(_percentile(vals, 99) * 1000.0, 3),
+            "max_ms": round((vals[-1] if vals else 0.0) * 1000.0, 3),
+        }
+
+class LatencyTracker:
+    """
+    Ventanas de latencia por clave (p.ej. por cliente). Conserva como máximo
+    `max_keys` claves, descartando la usada hace más tiempo.
+    """
+
+    def __init__(self, max_keys: int = 64, maxlen: int = 1000):
+        self._lock = threading.Lock()
+        self._windows: "OrderedDict[str, LatencyWindow]" = OrderedDict()
+        self._max_keys = max_keys
+        self._maxlen = maxlen
+
+    def add(self, key: str, seconds: float) -> None:
+        with self._lock:
+            win: Optional[LatencyWindow] = self._windows.get(key)
+            if win is None:
+                win = LatencyWindow(self._maxlen)
+                self._windows[key] = win
+                while len(self._windows) > self._max_keys:
+                    self._windows.popitem(last=False)
+            else:
+                self._windows.move_to_end(key)
+        win.add(seconds)
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            items = list(self._windows.items())
+        return {k: w.summary() for k, w in items}
+
+class TimedLock:
+    """
+    threading.Lock que mide cuánto se espera para adquirirlo. Compatible con
+    `with` y con threading.Condition. Sin contención no consulta el reloj.
+    Las muestras se guardan con el lock ya tomado, así que no necesitan otro lock.
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self._lock = threading.Lock()
+        self._waits: Deque[float] = deque(maxlen=maxlen)  # solo esperas con contención
+        self._acquires = 0
+        self._contended = 0
+        self._total_wait = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(False):
+            self._acquires += 1
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        dt = time.perf_counter() - t0
+        self._acquires += 1
+        self._contended += 1
+        self._total_wait += dt
+        self._waits.append(dt)
+        return True
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc) -> None:
+        self._lock.release()
+
+    def stats(self) -> dict:
+        vals = sorted(list(self._waits))
+        return {
+            "acquires": self._acquires,
+            "contended": self._contended,
+            "total_wait_ms": round(self._total_wait * 1000.0, 3),
+            "p50_wait_ms": round(_percentile(vals, 50) * 1000.0, 3),
+            "p99_wait_ms": round(_percentile(vals, 99) * 1000.0, 3),
+            "max_wait_ms": round((vals[-1] if vals else 0.0) * 1000.0, 3),
+        }
@@ -0,0 +1,358 @@
+import math
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple, Deque, List, Sequence
+
+_SEGMENT_RE = re.compile(r"^rec_\d{8}_\d{6}_\d+\.mjpg$")
+
+def _check_duration(name: str, value, allow_zero: bool) -> None:
+    # rechaza NaN/Infinity (el JSON de Flask los acepta) y valores fuera de rango
+    v = float(value)
+    if not math.isfinite(v):
+        raise ValueError(f"{name} debe ser finito")
+    if v < 0 or (v == 0 and not allow_zero):
+        raise ValueError(f"{name} debe ser {'>= 0' if allow_zero else '> 0'}")
+
+class Recorder:
+    """
+    Consumidor de frames JPEG ya codificados (los del stream anotado) que graba
+    segmentos MJPEG a disco sin frenar el bucle de captura:
+      - push() es O(1) y nunca bloquea: si ya hay `queue_size` frames en vivo
+        pendientes, el frame se descarta y se cuenta en `dropped`.
+      - Mantiene un ring en memoria con los últimos `pre_s` segundos para grabar
+        lo ocurrido ANTES de un evento (trigger_event). El ring se entrega al
+        writer como un único lote, sin pasar por el límite de la cola.
+      - Un hilo writer dedicado escribe con buffer grande y rota segmentos por
+        tiempo o tamaño. Un error de disco (OSError) cierra el segmento, se
+        cuenta en `write_errors`/`last_error` y el writer sigue vivo: descarta
+        frames durante `retry_s` y vuelve a abrir un segmento nuevo.
+    Los segmentos son MJPEG crudo (JPEGs concatenados), reproducible con
+    ffmpeg/VLC (`ffplay -f mjpeg archivo.mjpg`).
+    """
+
+    def __init__(self,
+                 out_dir: str = "recordings",
+                 pre_s: float = 5.0,
+                 post_s: float = 5.0,
+                 segment_s: float = 60.0,
+                 segment_bytes: int = 256 * 1024 * 1024,
+                 queue_size: int = 256,
+                 ring_max_fps: float = 120.0,
+                 write_buffer: int = 1024 * 1024,
+                 flush_interval_s: float = 1.0,
+                 retry_s: float = 1.0):
+        self.out_dir = out_dir
+        self._lock = threading.Lock()
+
+        self._pre_s = 0.0
+        self._post_s = 0.0
+        self._segment_s = 0.0
+        self._segment_bytes = 0
+        self._write_buffer = int(write_buffer)
+        self._flush_interval_s = float(flush_interval_s)
+        self._retry_s = float(retry_s)
+
+        # (ts_monotonic, jpeg); el tamaño máximo se deriva de pre_s (ver _resize_ring_locked)
+        self._ring_max_fps = float(ring_max_fps)
+        self._ring: Deque[Tuple[float, bytes]] = deque(maxlen=1)
+        # Cada item es un lote de (ts, jpeg): 1 frame en vivo o el ring pre-evento completo.
+        # Sin maxsize: el límite (queue_size) se aplica solo a frames en vivo, en push().
+        self._queue: "queue.Queue[Sequence[Tuple[float, bytes]]]" = queue.Queue()
+        self._queue_size = int(queue_size)
+
+        self._continuous = False
+        self._event_until = 0.0
+
+        # contadores
+        self._dropped = 0
+        self._written_frames = 0
+        self._segments = 0
+        self._write_errors = 0
+        self._last_error: Optional[str] = None
+
+        # estado del writer (solo lo toca el hilo writer, salvo lectura en stats)
+        self._writer: Optional[threading.Thread] = None
+        self._writer_stop = threading.Event()
+        self._current_name: Optional[str] = None
+
+        self.configure(pre_s=pre_s, post_s=post_s, segment_s=segment_s, segment_bytes=segment_bytes)
+
+    # -----------------------------
+    # Configuración / control
+    # -----------------------------
+
+    def configure(self, *, pre_s: Optional[float] = None, post_s: Optional[float] = None,
+                  segment_s: Optional[float] = None, segment_bytes: Optional[int] = None) -> dict:
+        """
+        Actualiza parámetros (los None se ignoran). Lanza ValueError si no son
+        finitos, si pre_s < 0 o si el resto no es > 0.
+        """
+        if pre_s is not None:
+            _check_duration("pre_s", pre_s, allow_zero=True)
+        for k, v in (("post_s", post_s), ("segment_s", segment_s), ("segment_bytes", segment_bytes)):
+            if v is not None:
+                _check_duration(k, v, allow_zero=False)
+        with self._lock:
+            if pre_s is not None:
+                self._pre_s = float(pre_s)
+                self._resize_ring_locked()
+            if post_s is not None:
+                self._post_s = float(post_s)
+            if segment_s is not None:
+                self._segment_s = float(segment_s)
+            if segment_bytes is not None:
+                self._segment_bytes = int(segment_bytes)
+        return self.stats()
+
+    def _resize_ring_locked(self) -> None:
+        # el ring debe poder guardar pre_s segundos al fps máximo esperado
+        maxlen = max(1, math.ceil(self._pre_s * self._ring_max_fps))
+        if self._ring.maxlen != maxlen:
+            self._ring = deque(self._ring, maxlen=maxlen)
+
+    def start_continuous(self) -> None:
+        """Graba todo lo que llegue hasta stop()."""
+        self._ensure_writer()
+        with self._lock:
+            if not self._is_recording(time.monotonic()):
+                self._flush_ring_locked(time.monotonic() - self._pre_s)
+            self._continuous = True
+
+    def trigger_event(self, pre_s: Optional[float] = None, post_s: Optional[float] = None) -> None:
+        """
+        Graba alrededor de un evento: los últimos `pre_s` s del ring y los próximos
+        `post_s` s. Si ya se está grabando, solo extiende la ventana.
+        Lanza ValueError con las mismas reglas que configure(); pre_s no puede
+        superar el pre_s configurado (el ring no guarda más).
+        """
+        if pre_s is not None:
+            _check_duration("pre_s", pre_s, allow_zero=True)
+        if post_s is not None:
+            _check_duration("post_s", post_s, allow_zero=False)
+        self._ensure_writer()
+        now = time.monotonic()
+        with self._lock:
+            if pre_s is not None and float(pre_s) > self._pre_s:
+                raise ValueError(f"pre_s no puede superar el configurado ({self._pre_s} s)")
+            pre = self._pre_s if pre_s is None else float(pre_s)
+            post = self._post_s if post_s is None else float(post_s)
+            if not self._is_recording(now):
+                self._flush_ring_locked(now - pre)
+            self._event_until = max(self._event_until, now + post)
+
+    def stop(self) -> None:
+        """Detiene la grabación (continua y de evento). El writer cierra el segmento."""
+        with self._lock:
+            self._continuous = False
+            self._event_until = 0.0
+
+    def close(self) -> None:
+        """Detiene la grabación y el hilo writer (vacía lo pendiente)."""
+        self.stop()
+        self._writer_stop.set()
+        if self._writer and self._writer.is_alive():
+            self._writer.join(timeout=5.0)
+        self._writer = None
+
+    # -----------------------------
+    # Ruta caliente (hilo de captura)
+    # -----------------------------
+
+    def push(self, jpeg: bytes, ts: Optional[float] = None) -> None:
+        """Entrega un frame codificado. Nunca bloquea."""
+        ts = time.monotonic() if ts is None else ts
+        with self._lock:
+            self._ring.append((ts, jpeg))
+            # recorta el ring a la ventana pre-evento
+            limit = ts - self._pre_s
+            while self._ring and self._ring[0][0] < limit:
+                self._ring.popleft()
+            if not self._is_recording(ts):
+                return
+            # si el writer murió (error inesperado) se relanza; tras close() no
+            if not self._writer_stop.is_set():
+                self._start_writer_locked()
+            self._enqueue_locked(ts, jpeg)
+
+    def _is_recording(self, now: float) -> bool:
+        # requiere self._lock tomado
+        return self._continuous or now < self._event_until
+
+    def _enqueue_locked(self, ts: float, jpeg: bytes) -> None:
+        # solo frames en vivo: si el disco va lento, se descarta y se cuenta
+        if self._queue.qsize() >= self._queue_size:
+            self._dropped += 1
+            return
+        self._queue.put_nowait(((ts, jpeg),))
+
+    def _flush_ring_locked(self, since: float) -> None:
+        # el ring ya está en memoria: se entrega entero como un solo item (nunca se descarta)
+        batch = [(ts, jpeg) for ts, jpeg in self._ring if ts >= since]
+        if batch:
+            self._queue.put_nowait(batch)
+
+    # -----------------------------
+    # Writer
+    # -----------------------------
+
+    def _ensure_writer(self) -> None:
+        os.makedirs(self.out_dir, exist_ok=True)
+        with self._lock:
+            self._writer_stop.clear()
+            self._start_writer_locked()
+
+    def _start_writer_locked(self) -> None:
+        # requiere self._lock tomado (evita arrancar dos writers a la vez)
+        if self._writer and self._writer.is_alive():
+            return
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def _new_segment_name(self) -> str:
+        stamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        self._segments += 1
+        return f"rec_{stamp}_{self._segments}.mjpg"
+
+    def _write_failed(self, f, exc: OSError) -> None:
+        # cierra el segmento roto sin dejar que otro OSError (p.ej. al vaciar el buffer) mate al writer
+        with self._lock:
+            self._write_errors += 1
+            self._last_error = f"{type(exc).__name__}: {exc}"
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+        self._current_name = None
+
+    def _writer_loop(self) -> None:
+        f = None
+        seg_started = 0.0
+        seg_bytes = 0
+        last_flush = time.monotonic()
+        retry_at = 0.0  # tras un error de disco, no se reabre segmento antes de esto
+        try:
+            while True:
+                try:
+                    batch = self._queue.get(timeout=0.5)
+                except queue.Empty:
+                    with self._lock:
+                        recording = self._is_recording(time.monotonic())
+                    try:
+                        # sin frames y sin grabación activa -> cerrar segmento
+                        if f is not None and not recording:
+                            f.close()
+                            f = None
+                            self._current_name = None
+                        elif f is not None:
+                            # inactivo pero grabando: que GET /recordings/<name> vea lo último
+                            f.flush()
+                            last_flush = time.monotonic()
+                    except OSError as e:
+                        self._write_failed(f, e)
+                        f = None
+                        retry_at = time.monotonic() + self._retry_s
+                    if self._writer_stop.is_set():
+                        break
+                    continue
+
+                for ts, jpeg in batch:
+                    if f is None and time.monotonic() < retry_at:
+                        with self._lock:
+                            self._dropped += 1
+                        continue
+                    try:
+                        # rotación por tiempo o tamaño (close() vacía el buffer)
+                        if f is not None and (ts - seg_started >= self._segment_s or seg_bytes >= self._segment_bytes):
+                            f.close()
+                            f = None
+                        if f is None:
+                            # por si out_dir se borró mientras se grababa
+                            os.makedirs(self.out_dir, exist_ok=True)
+                            name = self._new_segment_name()
+                            f = open(os.path.join(self.out_dir, name), "wb", buffering=self._write_buffer)
+                            self._current_name = name
+                            seg_started = ts
+                            seg_bytes = 0
+
+                        f.write(jpeg)
+                    except OSError as e:
+                        self._write_failed(f, e)
+                        f = None
+                        retry_at = time.monotonic() + self._retry_s
+                        with self._lock:
+                            self._dropped += 1
+                        continue
+                    seg_bytes += len(jpeg)
+                    self._written_frames += 1
+
+                # flush periódico: el segmento activo no se queda hasta 1 buffer por detrás
+                if f is not None and time.monotonic() - last_flush >= self._flush_interval_s:
+                    try:
+                        f.flush()
+                    except OSError as e:
+                        self._write_failed(f, e)
+                        f = None
+                        retry_at = time.monotonic() + self._retry_s
+                    last_flush = time.monotonic()
+        finally:
+            if f is not None:
+                try:
+                    f.close()
+                except OSError as e:
+                    self._write_failed(None, e)
+            self._current_name = None
+
+    # -----------------------------
+    # Consulta de grabaciones
+    # -----------------------------
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "recording": self._is_recording(now),
+                "mode": "continuous" if self._continuous else ("event" if now < self._event_until else "idle"),
+                "pre_s": self._pre_s,
+                "post_s": self._post_s,
+                "segment_s": self._segment_s,
+                "segment_bytes": self._segment_bytes,
+                "ring_frames": len(self._ring),
+                "queued": self._queue.qsize(),
+                "dropped": self._dropped,
+                "written_frames": self._written_frames,
+                "current_segment": self._current_name,
+                "writer_alive": bool(self._writer and self._writer.is_alive()),
+                "write_errors": self._write_errors,
+                "last_error": self._last_error,
+            }
+
+    def list_recordings(self) -> List[dict]:
+        """Segmentos en disco (más recientes primero)."""
+        if not os.path.isdir(self.out_dir):
+            return []
+        current = self._current_name
+        out = []
+        for entry in os.scandir(self.out_dir):
+            if not entry.is_file() or not _SEGMENT_RE.match(entry.name):
+                continue
+            st = entry.stat()
+            out.append({
+                "name": entry.name,
+                "size": st.st_size,
+                "modified_at": st.st_mtime,
+                "active": entry.name == current,
+            })
+        out.sort(key=lambda r: r["modified_at"], reverse=True)
+        return out
+
+    def path_for(self, name: str) -> Optional[str]:
+        """Ruta absoluta de un segmento válido (None si el nombre no es válido o no existe)."""
+        if not _SEGMENT_RE.match(name):
+            return None
+        path = os.path.join(os.path.abspath(self.out_dir), name)
+        return path if os.path.isfile(path) else None
@@ -1,9 +1,17 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, send_file
 from camera_worker import CameraWorker
+import atexit
+import base64
+import json
+import math
 import time
-from typing import Tuple, List, Any
+from itertools import chain, islice
+from typing import Tuple, List, Any, Optional
 from werkzeug.exceptions import BadRequest
 from db_service import DatabaseService
+from recorder import Recorder
+from latency import LatencyTracker
+from utils import BBOX_BIN_MIMETYPE, BBOX_ID_MIN, BBOX_ID_MAX, decode_bboxes_bin, encode_bboxes_bin
 
 db = DatabaseService("app.db")
 db.init_db()
@@ -11,6 +19,14 @@ db.init_db()
 app = Flask(__name__)
 worker = CameraWorker()
 
+recorder = Recorder("recordings")
+worker.add_frame_consumer(recorder.push)
+# al salir: vacía la cola y el buffer del segmento activo (si no, queda truncado)
+atexit.register(recorder.close)
+
+# latencia JPEG codificado -> enviado, por cliente
+sent_latency = LatencyTracker()
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Helpers: parseo de ángulo, color e hidratación de boundings
 # ─────────────────────────────────────────────────────────────────────────────
@@ -69,8 +85,17 @@ def _color_hex_from_input(d: dict) -> str:
         return f"#{r:02X}{g:02X}{b:02X}"
     return "#00FF00"
 
-def _hydrate_worker_from_db():
-    rows = db.get_all_bboxes()
+def _bgr_from_hex(hx: str) -> Tuple[int, int, int]:
+    # versión rápida de _parse_color_bgr para hex ya normalizado en DB ('#RRGGBB')
+    try:
+        v = int(hx.lstrip("#"), 16)
+    except (AttributeError, ValueError):
+        return (0, 255, 0)
+    return v & 0xFF, (v >> 8) & 0xFF, (v >> 16) & 0xFF
+
+def _load_bboxes_from_db() -> List[tuple]:
+    # cursor en streaming y sin ORDER BY: el worker no necesita orden
+    rows = db.iter_bboxes(fields=("id", "cx", "cy", "w", "h", "angle_deg_cv", "color_hex"), ordered=False)
     items_py = []
     for r in rows:
         bid = int(r["id"])
@@ -78,18 +103,61 @@ def _hydrate_worker_from_db():
         w   = float(r["w"]);  h  = float(r["h"])
         ang = float(r["angle_deg_cv"])
         # derivar BGR desde el hex guardado
-        col = _parse_color_bgr({"color_hex": r["color_hex"]})
+        col = _bgr_from_hex(r["color_hex"])
         items_py.append((bid, cx, cy, w, h, ang, col))
-    worker.set_bboxes(items_py)
-    return len(items_py)
+    return items_py
+
+# Nombre en la API -> columna en DB (para ?fields=)
+_BBOX_API_FIELDS = {
+    "id": "id",
+    "cx": "cx",
+    "cy": "cy",
+    "w": "w",
+    "h": "h",
+    "angle_deg": "angle_deg_cv",
+    "color_hex": "color_hex",
+    "created_at": "created_at",
+}
+
+def _encode_cursor(row: dict) -> str:
+    raw = f"{row['created_at']}|{int(row['id'])}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(token: str) -> Tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        created_at, bid = raw.rsplit("|", 1)
+        return created_at, int(bid)
+    except Exception as e:
+        raise ValueError("cursor 'after' inválido") from e
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Básicos / cámara
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _starting_response():
+    """
+    Si la cámara está arrancando (job aún no en 'streaming') devuelve un 409;
+    evita que /bbox compita con la hidratación desde DB. None si se puede operar.
+    """
+    if worker.is_running() and not worker.is_streaming():
+        job = worker.get_job() or {}
+        return jsonify({
+            "ok": False,
+            "msg": "La cámara se está iniciando",
+            "job_id": job.get("job_id"),
+            "state": job.get("state"),
+        }), 409
+    return None
+
 @app.get("/status")
 def status():
-    return jsonify({"running": worker.is_running()})
+    job = worker.get_job()
+    return jsonify({
+        "running": worker.is_running(),
+        "state": job["state"] if job else "idle",
+        "job_id": job["job_id"] if job else None,
+    })
 
 @app.get("/meta")
 def meta():
@@ -99,34 +167,56 @@ def meta():
 
 @app.post("/start")
 def start_camera():
+    """
+    Inicia la cámara SIN bloquear: responde 202 con un job_id y el estado inicial.
+    Apertura, negociación de resolución e hidratación desde DB corren en segundo
+    plano; consulta el progreso en GET /start/<job_id>.
+    """
     data = request.get_json(silent=True) or {}
     cam_index = int(data.get("index", 0))
 
-    # Si ya está corriendo:
-    if worker.is_running():
-        meta = worker.get_meta()
+    started, job = worker.start(cam_index, hydrate=_load_bboxes_from_db)
+
+    # El arranque anterior aún está liberando la cámara (p.ej. stop() a media negociación)
+    if not started and not worker.is_running():
+        return jsonify({
+            "ok": False,
+            "running": False,
+            "job": job,
+            "msg": "La cámara anterior aún se está liberando; reintenta en unos segundos"
+        }), 409
+
+    # Si ya está corriendo (o arrancando): devuelve el job actual, sin rehidratar
+    if not started:
         return jsonify({
             "ok": True,
             "running": True,
-            "hydrated": 0,  # <- sin rehidratación
-            "w": meta.get("frame_w"),
-            "h": meta.get("frame_h"),
+            "job": job,
             "msg": "Cámara ya estaba en ejecución"
         }), 200
 
-    # 2) Si NO está corriendo: iniciar y SÍ rehidratar
-    started, w, h = worker.start(cam_index)
-
-    if not started:
-        return jsonify({"ok": False, "msg": "La cámara ya estaba en ejecución"}), 500
-    count = _hydrate_worker_from_db()
     return jsonify({
         "ok": True,
         "running": True,
-        "hydrated": count,
-        "w": w,
-        "h": h
-    }), 200
+        "job": job,
+        "status_url": f"/start/{job['job_id']}"
+    }), 202
+
+@app.get("/start/<job_id>")
+def start_job_status(job_id: str):
+    """
+    Estado del job de arranque. Long-poll opcional:
+      ?wait=<s>         espera hasta s segundos (máx 30) a un cambio de estado
+      ?since=<estado>   estado que ya conoce el cliente (por defecto, espera a estado terminal)
+    """
+    try:
+        wait = min(max(float(request.args.get("wait", 0)), 0.0), 30.0)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "wait debe ser numérico"}), 400
+    job = worker.wait_job(job_id, since=request.args.get("since"), timeout=wait)
+    if job is None:
+        return jsonify({"ok": False, "msg": f"job {job_id} no existe"}), 404
+    return jsonify({"ok": True, "job": job})
 
 @app.post("/stop")
 def stop_camera():
@@ -143,6 +233,9 @@ def stop_camera():
 def upsert_bbox():
     if not worker.is_running():
         return jsonify({"ok": False, "msg": "La cámara no está en ejecución"}), 400
+    busy = _starting_response()
+    if busy:
+        return busy
 
     data = request.get_json(force=True) or {}
 
@@ -192,6 +285,9 @@ def patch_bbox(bid: int):
         return jsonify({"ok": False, "msg": "JSON inválido o Content-Type incorrecto"}), 400
     if not isinstance(data, dict):
         return jsonify({"ok": False, "msg": "Cuerpo JSON debe ser un objeto"}), 400
+    busy = _starting_response()
+    if busy:
+        return busy
 
     # 2) Cargar estado actual DESDE DB (fuente de verdad para PATCH)
     cur = db.get_bbox(bid)
@@ -258,6 +354,10 @@ def patch_bbox(bid: int):
 
 @app.delete("/bbox/<int:bid>")
 def delete_bbox(bid: int):
+    busy = _starting_response()
+    if busy:
+        return busy
+
     # 1) Quitar del worker si está corriendo (best-effort)
     removed_worker = False
     if worker.is_running():
@@ -293,19 +393,132 @@ def delete_bbox(bid: int):
 
 @app.get("/bboxes")
 def get_bboxes():
-    # Devuelve bounding boxes.
-    rows = db.get_all_bboxes()
-    items = [{
-        "id": int(r["id"]),
-        "cx": float(r["cx"]),
-        "cy": float(r["cy"]),
-        "w":  float(r["w"]),
-        "h":  float(r["h"]),
-        "angle_deg": float(r["angle_deg_cv"]),
-        "color_hex": r["color_hex"],
-        "created_at": r["created_at"],
-    } for r in rows]
-    return jsonify({"ok": True, "source": "db", "items": items})
+    """
+    Devuelve bounding boxes desde DB (más recientes primero), en streaming.
+    Query params (todos opcionales):
+      limit=<n>                 tamaño de página (1..10000); la respuesta trae "next"
+      after=<cursor>            valor "next" de la página anterior (paginación keyset)
+      fields=id,cx,cy,...       proyección de campos (nombres de la API)
+      region=x0,y0,x1,y1        solo cajas con centro dentro del rectángulo
+      color=#RRGGBB             solo cajas de ese color
+    Con Accept: application/x-bbox-bin responde registros binarios (ignora fields).
+    Si la DB falla a mitad del stream (ya enviado el 200), el JSON se cierra igual
+    y trae "error"; los items ya enviados son válidos.
+    """
+    args = request.args
+    try:
+        limit: Optional[int] = None
+        if "limit" in args:
+            limit = int(args["limit"])
+            if not 1 <= limit <= 10000:
+                raise ValueError("limit debe estar entre 1 y 10000")
+        after = _decode_cursor(args["after"]) if args.get("after") else None
+
+        fields = list(_BBOX_API_FIELDS)
+        if args.get("fields"):
+            fields = [f.strip() for f in args["fields"].split(",") if f.strip()]
+            unknown = set(fields) - set(_BBOX_API_FIELDS)
+            if unknown:
+                raise ValueError(f"campos desconocidos: {sorted(unknown)}")
+
+        region = None
+        if args.get("region"):
+            region = tuple(float(v) for v in args["region"].split(","))
+            if len(region) != 4:
+                raise ValueError("region debe ser x0,y0,x1,y1")
+
+        color = None
+        if args.get("color"):
+            hx = args["color"].strip().lstrip("#")
+            if len(hx) != 6:
+                raise ValueError("color debe ser #RRGGBB")
+            int(hx, 16)
+            color = f"#{hx.upper()}"
+    except ValueError as e:
+        return jsonify({"ok": False, "msg": f"Parámetros inválidos: {e}"}), 400
+
+    def _rows(cols):
+        # id y created_at siempre se leen: hacen falta para el cursor
+        return db.iter_bboxes(limit=limit, after=after, region=region, color_hex=color,
+                              fields=set(cols) | {"id", "created_at"})
+
+    # Formato binario compacto si el cliente lo pide en Accept
+    if request.accept_mimetypes.best_match(["application/json", BBOX_BIN_MIMETYPE]) == BBOX_BIN_MIMETYPE:
+        # ids heredados fuera de int32 no se pueden empaquetar: fallar ANTES de empezar a enviar
+        if db.has_ids_outside(BBOX_ID_MIN, BBOX_ID_MAX):
+            return jsonify({"ok": False, "msg": "Hay ids fuera de int32; usa el formato JSON"}), 422
+        rows = _rows(("cx", "cy", "w", "h", "angle_deg_cv", "color_hex"))
+
+        def _records(it):
+            for r in it:
+                yield r["id"], r["cx"], r["cy"], r["w"], r["h"], r["angle_deg_cv"], _bgr_from_hex(r["color_hex"])
+
+        try:
+            if limit is not None:
+                # página acotada: se materializa para poder dar el cursor en cabecera
+                page = list(rows)
+                headers = {"X-Bbox-Count": str(len(page))}
+                if len(page) == limit:
+                    headers["X-Next-Cursor"] = _encode_cursor(page[-1])
+                return Response(encode_bboxes_bin(_records(page)), mimetype=BBOX_BIN_MIMETYPE, headers=headers)
+
+            # primer bloque ANTES de responder: un error de DB aquí aún puede ser un 500
+            recs = _records(rows)
+            first = encode_bboxes_bin(islice(recs, 1000))
+        except Exception as e:
+            app.logger.exception("Error al leer bboxes (binario)")
+            return jsonify({"ok": False, "msg": f"Error DB: {e}"}), 500
+
+        def gen_bin():
+            yield first
+            try:
+                while True:
+                    chunk = list(islice(recs, 1000))
+                    if not chunk:
+                        break
+                    yield encode_bboxes_bin(chunk)
+            except Exception:
+                # el 200 ya salió: se corta el cuerpo (longitud no múltiplo del registro o incompleta)
+                app.logger.exception("Error a mitad del stream binario de /bboxes")
+
+        return Response(gen_bin(), mimetype=BBOX_BIN_MIMETYPE)
+
+    projection = [(f, _BBOX_API_FIELDS[f]) for f in fields]
+    try:
+        # primer bloque ANTES de responder: un error de DB aquí aún puede ser un 500
+        rows = _rows(_BBOX_API_FIELDS[f] for f in fields)
+        head = list(islice(rows, 500))
+    except Exception as e:
+        app.logger.exception("Error al leer bboxes")
+        return jsonify({"ok": False, "msg": f"Error DB: {e}"}), 500
+
+    def gen_json():
+        yield b'{"ok": true, "source": "db", "items": ['
+        last = None
+        count = 0
+        error = None
+        buf: List[str] = []
+        try:
+            for r in chain(head, rows):
+                buf.append(json.dumps({name: r[col] for name, col in projection}))
+                last = r
+                count += 1
+                if len(buf) >= 500:
+                    yield ((", " if count > len(buf) else "") + ", ".join(buf)).encode("utf-8")
+                    buf = []
+        except Exception as e:
+            # el 200 ya salió: se cierra el JSON de forma válida y se informa en "error"
+            app.logger.exception("Error a mitad del stream de /bboxes")
+            error = f"Error DB: {e}"
+        if buf:
+            yield ((", " if count > len(buf) else "") + ", ".join(buf)).encode("utf-8")
+        nxt = _encode_cursor(last) if error is None and limit is not None and count == limit else None
+        tail = f'], "count": {count}, "next": {json.dumps(nxt)}'
+        if error is not None:
+            tail += f', "error": {json.dumps(error)}'
+        yield (tail + "}").encode("utf-8")
+
+    return Response(gen_json(), mimetype="application/json")
 
 @app.put("/bboxes")
 def put_bboxes():
@@ -316,9 +529,22 @@ def put_bboxes():
         {"id": 1, "cx":..., "cy":..., "w":..., "h":..., "angle_deg":..., "color_rgb":[r,g,b]},
         ...
       ]
+    También acepta Content-Type: application/x-bbox-bin con registros BBOX_DTYPE
+    empaquetados (ver utils.py); se valida el lote entero de forma vectorizada.
     """
     if not worker.is_running():
         return jsonify({"ok": False, "msg": "Cámara no está en ejecución"}), 400
+    busy = _starting_response()
+    if busy:
+        return busy
+
+    if request.mimetype == BBOX_BIN_MIMETYPE:
+        try:
+            arr = decode_bboxes_bin(request.get_data(cache=False))
+        except ValueError as e:
+            return jsonify({"ok": False, "msg": f"Payload inválido: {e}"}), 400
+        count = worker.set_bboxes_array(arr)
+        return jsonify({"ok": True, "count": count})
 
     items_json: List[dict] = request.get_json(force=True)
     items_py: List[Any] = []
@@ -337,43 +563,163 @@ def put_bboxes():
 def clear_bboxes():
     if not worker.is_running():
         return jsonify({"ok": False, "msg": "Cámara no está en ejecución"}), 400
+    busy = _starting_response()
+    if busy:
+        return busy
     worker.clear_bboxes()
     return jsonify({"ok": True})
 
+# ─────────────────────────────────────────────────────────────────────────────
+# Overlay: nivel de detalle (LOD)
+# ─────────────────────────────────────────────────────────────────────────────
+
+@app.get("/overlay/lod")
+def get_overlay_lod():
+    return jsonify({"ok": True, "lod": worker.get_lod()})
+
+@app.put("/overlay/lod")
+def put_overlay_lod():
+    """
+    Actualiza parcialmente los umbrales LOD, p.ej.:
+      {"cull_offscreen": true, "min_box_px": 1, "min_label_px": 12, "max_labels": 300}
+    """
+    try:
+        data = request.get_json(silent=False)
+    except BadRequest:
+        return jsonify({"ok": False, "msg": "JSON inválido o Content-Type incorrecto"}), 400
+    if not isinstance(data, dict):
+        return jsonify({"ok": False, "msg": "Cuerpo JSON debe ser un objeto"}), 400
+    try:
+        lod = worker.set_lod(**data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "msg": f"Payload inválido: {e}"}), 400
+    return jsonify({"ok": True, "lod": lod})
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Grabación (segmentos MJPEG en disco)
+# ─────────────────────────────────────────────────────────────────────────────
+
+def _recorder_params(data: dict) -> dict:
+    # segment_mb es más cómodo desde el cliente; se convierte a bytes.
+    # El rango (finito, pre_s >= 0, resto > 0) lo valida Recorder, igual para todos los endpoints.
+    params = {k: float(data[k]) for k in ("pre_s", "post_s", "segment_s") if k in data}
+    if "segment_mb" in data:
+        mb = float(data["segment_mb"])
+        if not math.isfinite(mb):
+            raise ValueError("segment_mb debe ser finito")
+        params["segment_bytes"] = int(mb * 1024 * 1024)
+    return params
+
+@app.get("/recordings")
+def list_recordings():
+    return jsonify({"ok": True, "recorder": recorder.stats(), "items": recorder.list_recordings()})
+
+@app.post("/recordings/start")
+def start_recording():
+    """
+    Grabación continua hasta /recordings/stop.
+    Body opcional: {"segment_s": 60, "segment_mb": 256, "pre_s": 5}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        recorder.configure(**_recorder_params(data))
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "msg": f"Payload inválido: {e}"}), 400
+    recorder.start_continuous()
+    return jsonify({"ok": True, "recorder": recorder.stats()})
+
+@app.post("/recordings/event")
+def record_event():
+    """
+    Graba alrededor de un evento: los últimos pre_s s (ring en memoria) + los próximos post_s s.
+    Body opcional: {"pre_s": 5, "post_s": 10}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        params = _recorder_params(data)
+        recorder.trigger_event(pre_s=params.get("pre_s"), post_s=params.get("post_s"))
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "msg": f"Payload inválido: {e}"}), 400
+    return jsonify({"ok": True, "recorder": recorder.stats()})
+
+@app.post("/recordings/stop")
+def stop_recording():
+    recorder.stop()
+    return jsonify({"ok": True, "recorder": recorder.stats()})
+
+@app.get("/recordings/<name>")
+def get_recording(name: str):
+    # conditional=True -> soporta Range / If-Modified-Since (descarga parcial y seek)
+    path = recorder.path_for(name)
+    if path is None:
+        return jsonify({"ok": False, "msg": f"grabación {name} no existe"}), 404
+    return send_file(path, mimetype="video/x-motion-jpeg", conditional=True, max_age=0)
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Imagen / stream
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _client_key(kind: str) -> str:
+    # ?client=<nombre> permite al cliente identificarse; si no, su IP. Sin puerto: es
+    # efímero y cada conexión (p.ej. cada poll de /snapshot.jpg) sería un cliente nuevo.
+    name = request.args.get("client") or request.remote_addr or "?"
+    return f"{kind} {name}"
+
+def _frame_headers(frame) -> dict:
+    # X-Frame-Timestamp: instante de captura en segundos de reloj monotónico del servidor
+    return {
+        "X-Frame-Seq": str(frame.seq),
+        "X-Frame-Timestamp": f"{frame.ts_capture:.6f}",
+    }
+
 @app.get("/snapshot.jpg")
 def snapshot():
     if not worker.is_running():
         return jsonify({"ok": False, "msg": "Cámara no está en ejecución"}), 400
-    jpeg = worker.get_last_jpeg()
-    if not jpeg:
+    frame = worker.get_last_frame()
+    if not frame:
         return jsonify({"ok": False, "msg": "Aún no hay frame"}), 503
     headers = {
         "Cache-Control": "no-cache, no-store, must-revalidate",
         "Pragma": "no-cache",
         "Expires": "0",
+        **_frame_headers(frame),
     }
-    return Response(jpeg, mimetype="image/jpeg", headers=headers)
+    resp = Response(frame.jpeg, mimetype="image/jpeg", headers=headers)
+    key = _client_key("snapshot")
+    resp.call_on_close(lambda: sent_latency.add(key, time.monotonic() - frame.ts_encoded))
+    return resp
 
 @app.get("/stream.mjpg")
 def stream_mjpeg():
     if not worker.is_running():
         return jsonify({"ok": False, "msg": "Cámara no está en ejecución"}), 400
 
+    key = _client_key("stream")
+
     def gen():
         boundary = "--frame"
+        last_seq = 0
+        last_sent = 0.0
         while worker.is_running():
-            jpeg = worker.get_last_jpeg()
-            if jpeg:
-                yield (
-                    f"{boundary}\r\n"
-                    "Content-Type: image/jpeg\r\n"
-                    f"Content-Length: {len(jpeg)}\r\n\r\n"
-                ).encode("utf-8") + jpeg + b"\r\n"
-            time.sleep(0.03)
+            # máx ~33 FPS por cliente; luego espera al siguiente frame NUEVO (sin reenviar duplicados)
+            pause = 0.03 - (time.monotonic() - last_sent)
+            if pause > 0:
+                time.sleep(pause)
+            frame = worker.wait_frame(last_seq, timeout=1.0)
+            if frame is None:
+                continue
+            hdrs = "".join(f"{k}: {v}\r\n" for k, v in _frame_headers(frame).items())
+            yield (
+                f"{boundary}\r\n"
+                "Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(frame.jpeg)}\r\n"
+                f"{hdrs}\r\n"
+            ).encode("utf-8") + frame.jpeg + b"\r\n"
+            # al reanudar, el servidor ya escribió la parte anterior
+            last_sent = time.monotonic()
+            sent_latency.add(key, last_sent - frame.ts_encoded)
+            last_seq = frame.seq
         yield b"--frame--\r\n"
 
     headers = {
@@ -384,6 +730,21 @@ def stream_mjpeg():
     }
     return Response(gen(), mimetype="multipart/x-mixed-replace; boundary=frame", headers=headers)
 
+@app.get("/latency")
+def latency():
+    """
+    Percentiles (ms) de latencia por tramo:
+      capture_to_encoded: captura (cap.read) -> JPEG publicado
+      encoded_to_sent:    JPEG publicado -> entregado al socket, por cliente (IP o ?client=)
+      locks:              espera para adquirir cada lock del worker
+    """
+    return jsonify({
+        "ok": True,
+        "capture_to_encoded": worker.get_capture_latency(),
+        "encoded_to_sent": sent_latency.summary(),
+        "locks": worker.get_lock_stats(),
+    })
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Opcional: CORS (si accederás desde otra app/puerto)
 # from flask_cors import CORS